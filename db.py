@@ -3,6 +3,7 @@ import os
 from pathlib import Path
 import uuid
 import secrets
+from decimal import Decimal
 
 # Third-party imports
 import apsw
@@ -54,15 +55,17 @@ def get_user(user_id):
 
 # --- Email Endpoint Functions ---
 
-def create_email_endpoint(user_id, email, label, base_price):
-    """Create a new email endpoint."""
-    cur = conn.cursor()
+def create_email_endpoint(user_id, email, label, base_price, price_tiers=()):
+    """Create a new email endpoint, together with its size tiers in one transaction."""
     endpoint_id = str(uuid.uuid4())
     short_url = secrets.token_urlsafe(8)
-    cur.execute("""
-        INSERT INTO email_endpoints (id, user_id, email, label, short_url, base_price)
-        VALUES (?, ?, ?, ?, ?, ?)
-    """, (endpoint_id, user_id, email, label, short_url, int(base_price * 1_000_000)))
+    with conn:
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO email_endpoints (id, user_id, email, label, short_url, base_price)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (endpoint_id, user_id, email, label, short_url, int(base_price * 1_000_000)))
+        if price_tiers: set_price_tiers(endpoint_id, price_tiers)
     return endpoint_id
 
 
@@ -102,6 +105,23 @@ def get_endpoint_by_short_url(short_url):
     })
 
 
+def get_endpoint(endpoint_id):
+    """Get endpoint by ID (active or not)."""
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT id, user_id, email, label, short_url, base_price, is_active, hit_count, payment_count, created_at
+        FROM email_endpoints WHERE id = ?
+    """, (endpoint_id,))
+    row = cur.fetchone()
+    if not row:
+        return None
+    return dict2obj({
+        "id": row[0], "user_id": row[1], "email": row[2], "label": row[3],
+        "short_url": row[4], "base_price": row[5] / 1_000_000, "is_active": row[6],
+        "hit_count": row[7], "payment_count": row[8], "created_at": row[9]
+    })
+
+
 def update_hit_count(endpoint_id):
     """Increment hit count for an endpoint."""
     cur = conn.cursor()
@@ -116,3 +136,147 @@ def update_pay_count(endpoint_id):
     cur.execute("""
         UPDATE email_endpoints SET payment_count = payment_count + 1 WHERE id = ?
     """, (endpoint_id,))
+
+
+
+def set_price_tiers(endpoint_id, tiers):
+    """Replace an endpoint's size tiers with `tiers`, a list of (min_bytes, price)."""
+    with conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM endpoint_price_tiers WHERE endpoint_id = ?", (endpoint_id,))
+        cur.executemany("""
+            INSERT INTO endpoint_price_tiers (endpoint_id, min_bytes, price) VALUES (?, ?, ?)
+        """, [(endpoint_id, int(min_bytes), round(price * 1_000_000)) for min_bytes, price in tiers])
+
+
+def get_price_tiers(endpoint_id):
+    """List an endpoint's size tiers as (min_bytes, price), smallest first."""
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT min_bytes, price FROM endpoint_price_tiers WHERE endpoint_id = ? ORDER BY min_bytes
+    """, (endpoint_id,))
+    return [(row[0], row[1] / 1_000_000) for row in cur.fetchall()]
+
+# --- Payment Functions ---
+
+def record_payment(endpoint_id, sender_email, subject, amount, network=None, payer=None, transaction_hash=None):
+    """Record a settled payment for an endpoint. `amount` is the Decimal USDC amount charged."""
+    cur = conn.cursor()
+    payment_id = str(uuid.uuid4())
+    cur.execute("""
+        INSERT INTO payments (id, endpoint_id, sender_email, subject, amount, network, payer, transaction_hash)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, (payment_id, endpoint_id, sender_email, subject, int(amount * 10**6), network, payer, transaction_hash))
+    return payment_id
+
+
+# --- Export Functions ---
+#
+# Exports read through their own read-only connection in keyset-paginated batches,
+# so each batch is a short statement: memory stays bounded by the batch size and
+# no read snapshot is held open for the whole download (WAL checkpoints keep running).
+
+ENDPOINT_EXPORT_COLUMNS = ("id", "email", "label", "short_url", "base_price", "is_active",
+                           "hit_count", "payment_count", "created_at")
+
+PAYMENT_EXPORT_COLUMNS = ("id", "endpoint_id", "endpoint_label", "sender_email", "subject", "amount",
+                          "network", "payer", "transaction_hash", "created_at")
+
+
+def _iter_rows(sql, params):
+    """Yield rows of `sql` straight off one cursor on a read-only connection.
+
+    The rows come from a single WAL snapshot without being buffered, and the reader
+    blocks no writer. Checkpoints cannot pass that snapshot until the export ends.
+    """
+    read_conn = apsw.Connection(str(db_path), flags=apsw.SQLITE_OPEN_READONLY)
+    try: yield from read_conn.execute(sql, params)
+    finally: read_conn.close()
+
+
+def _date_filters(column, start, end):
+    """SQL clause and params for an inclusive [start, end] date range on `column` (ISO dates or None)."""
+    clause, params = "", ()
+    if start:
+        clause += f" AND {column} >= ?"
+        params += (start,)
+    if end:
+        clause += f" AND {column} < date(?, '+1 day')"
+        params += (end,)
+    return clause, params
+
+
+def iter_endpoints_by_user(user_id, start=None, end=None):
+    """Stream a user's endpoints (oldest first) as dicts, optionally filtered by creation date."""
+    date_clause, date_params = _date_filters("created_at", start, end)
+    sql = f"""
+        SELECT id, email, label, short_url, base_price, is_active, hit_count, payment_count, created_at
+        FROM email_endpoints
+        WHERE user_id = ? {date_clause}
+        ORDER BY created_at, id
+    """
+    for row in _iter_rows(sql, (user_id, *date_params)):
+        record = dict(zip(ENDPOINT_EXPORT_COLUMNS, row))
+        record["base_price"] = record["base_price"] / 1_000_000
+        yield record
+
+
+def iter_payments_by_user(user_id, start=None, end=None):
+    """Stream payments received on a user's endpoints (oldest first) as dicts, optionally filtered by date."""
+    date_clause, date_params = _date_filters("p.created_at", start, end)
+    sql = f"""
+        SELECT p.id, p.endpoint_id, e.label, p.sender_email, p.subject, p.amount,
+               p.network, p.payer, p.transaction_hash, p.created_at
+        FROM email_endpoints e JOIN payments p ON p.endpoint_id = e.id
+        WHERE e.user_id = ? {date_clause}
+        ORDER BY p.created_at, p.id
+    """
+    for row in _iter_rows(sql, (user_id, *date_params)):
+        record = dict(zip(PAYMENT_EXPORT_COLUMNS, row))
+        record["amount"] = record["amount"] / 1_000_000
+        yield record
+
+
+# --- Payment Journal Functions ---
+#
+# These run inside journal.PaymentJournal batches; call them through the journal
+# rather than directly so transitions are group-committed.
+
+def journal_insert(entry_id, endpoint_id, state, sender_email, subject, message, amount, payment_header):
+    """Insert a new journal entry. `amount` is the Decimal USDC amount to charge."""
+    cur = conn.cursor()
+    cur.execute("""
+        INSERT INTO payment_journal (id, endpoint_id, state, sender_email, subject, message, amount, payment_header)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, (entry_id, endpoint_id, state, sender_email, subject, message, int(amount * 10**6), payment_header))
+
+
+def journal_update(entry_id, state, settle_response=None, error=None, attempted=False, terminal=False):
+    """Move a journal entry to `state`. Terminal states drop the stored message body and payment header."""
+    cur = conn.cursor()
+    cur.execute("""
+        UPDATE payment_journal
+        SET state = ?1, settle_response = COALESCE(?2, settle_response), error = ?3,
+            attempts = attempts + ?4, updated_at = CURRENT_TIMESTAMP,
+            message = CASE WHEN ?5 THEN NULL ELSE message END,
+            payment_header = CASE WHEN ?5 THEN NULL ELSE payment_header END
+        WHERE id = ?6
+    """, (state, settle_response, error, int(attempted), terminal, entry_id))
+
+
+def list_incomplete_journal_entries(states):
+    """List journal entries still in one of `states`, oldest first."""
+    cur = conn.cursor()
+    cur.execute(f"""
+        SELECT id, endpoint_id, state, sender_email, subject, message, amount, settle_response, attempts, created_at, payment_header
+        FROM payment_journal WHERE state IN ({", ".join("?" * len(states))})
+        ORDER BY created_at
+    """, tuple(states))
+    return [
+        dict2obj({
+            "id": row[0], "endpoint_id": row[1], "state": row[2], "sender_email": row[3],
+            "subject": row[4], "message": row[5], "amount": Decimal(row[6]) / 10**6,
+            "settle_response": row[7], "attempts": row[8], "created_at": row[9], "payment_header": row[10]
+        })
+        for row in cur.fetchall()
+    ]
@@ -0,0 +1,50 @@
+import csv
+import io
+import json
+from typing import Iterable, Iterator
+
+EXPORT_FORMATS = {
+    "csv": "text/csv; charset=utf-8",
+    "ndjson": "application/x-ndjson",
+}
+
+CHUNK_ROWS = 200
+
+# Cells starting with these are evaluated as formulas by spreadsheet apps
+FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+
+def _csv_safe(value):
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES): return "'" + value
+    return value
+
+
+def stream_csv(columns: tuple, rows: Iterable[dict], chunk_rows: int = CHUNK_ROWS) -> Iterator[str]:
+    """Yield CSV text in chunks of `chunk_rows` rows, header first."""
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=columns, extrasaction="ignore")
+    writer.writeheader()
+    for i, row in enumerate(rows, 1):
+        writer.writerow({k: _csv_safe(v) for k, v in row.items()})
+        if i % chunk_rows == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+
+def stream_ndjson(rows: Iterable[dict], chunk_rows: int = CHUNK_ROWS) -> Iterator[str]:
+    """Yield newline-delimited JSON in chunks of `chunk_rows` rows."""
+    chunk = []
+    for row in rows:
+        chunk.append(json.dumps(row, default=str))
+        if len(chunk) == chunk_rows:
+            yield "\n".join(chunk) + "\n"
+            chunk = []
+    if chunk: yield "\n".join(chunk) + "\n"
+
+
+def stream_rows(fmt: str, columns: tuple, rows: Iterable[dict]) -> Iterator[str]:
+    if fmt == "csv": return stream_csv(columns, rows)
+    if fmt == "ndjson": return stream_ndjson(rows)
+    raise ValueError(f"Unsupported export format: {fmt}")
@@ -0,0 +1,210 @@
+import asyncio
+import json
+import logging
+import uuid
+from decimal import Decimal
+from enum import StrEnum
+from typing import Callable
+
+import apsw
+
+import db
+import x402
+
+logger = logging.getLogger(__name__)
+
+
+class PaymentState(StrEnum):
+    received = "received"
+    verified = "verified"
+    settled = "settled"
+    delivered = "delivered"
+    failed = "failed"
+
+
+INCOMPLETE_STATES = (PaymentState.received, PaymentState.verified, PaymentState.settled)
+MAX_DELIVERY_ATTEMPTS = 5
+BUSY_RETRY_MAX_DELAY = 1.0
+
+
+class PaymentJournal:
+    """Write-ahead journal of forward payment transitions with group commit.
+
+    Each `record_*` call queues its SQL and waits until it is committed. Writes
+    queued within `flush_interval` (or up to `max_batch` of them) share one
+    transaction, so concurrent payments pay for one commit instead of one each
+    while every caller still only proceeds once its transition is durable.
+
+    Each write runs in its own savepoint, so a failing write only fails its own
+    caller. If the database is locked the whole batch is requeued and retried
+    with backoff rather than dropped: a transition recorded after settlement
+    must not be lost to a transient SQLITE_BUSY.
+    """
+
+    def __init__(self, flush_interval: float = 0.005, max_batch: int = 64):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._pending: list[tuple[Callable[[], None], asyncio.Future]] = []
+        self._flush_handle: asyncio.TimerHandle | None = None
+        self._busy_retries = 0
+        # Entries a request in this process is still working on; recovery passes skip them
+        self.active: set[str] = set()
+
+    async def _write(self, op) -> None:
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._pending.append((op, fut))
+        if len(self._pending) >= self.max_batch: self.flush()
+        elif self._flush_handle is None: self._flush_handle = loop.call_later(self.flush_interval, self.flush)
+        await fut
+
+    def flush(self) -> None:
+        """Commit every queued write in a single transaction."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if not batch: return
+        outcomes = []
+        try:
+            with db.conn:
+                for op, fut in batch:
+                    try:
+                        with db.conn: op()  # nested: a savepoint per write
+                    except apsw.BusyError: raise
+                    except Exception as e:
+                        logger.error(f"Payment journal write failed: {e}")
+                        outcomes.append((fut, e))
+                    else: outcomes.append((fut, None))
+        except apsw.BusyError as e:
+            self._retry_later(batch, e)
+            return
+        except Exception as e:
+            logger.error(f"Payment journal commit failed for {len(batch)} entries: {e}")
+            outcomes = [(fut, e) for _, fut in batch]
+        self._busy_retries = 0
+        for fut, error in outcomes:
+            if fut.done(): continue
+            if error is None: fut.set_result(None)
+            else: fut.set_exception(error)
+
+    async def close(self, timeout: float = 5.0) -> None:
+        """Flush everything queued, waiting out a locked database for up to `timeout` seconds."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        self.flush()
+        while self._pending and loop.time() < deadline:
+            await asyncio.sleep(BUSY_RETRY_MAX_DELAY / 10)
+        if self._pending: logger.error(f"Payment journal closed with {len(self._pending)} unwritten transitions")
+
+    def _retry_later(self, batch, error) -> None:
+        self._busy_retries += 1
+        delay = min(self.flush_interval * 2 ** self._busy_retries, BUSY_RETRY_MAX_DELAY)
+        logger.warning(f"Payment journal busy ({error}), retrying {len(batch)} writes in {delay:.3f}s (attempt {self._busy_retries})")
+        self._pending = batch + self._pending
+        if self._flush_handle is not None: self._flush_handle.cancel()
+        self._flush_handle = asyncio.get_running_loop().call_later(delay, self.flush)
+
+    async def record_received(self, endpoint, sender_email: str, subject: str, message: str, amount: Decimal, payment_header: str) -> str:
+        entry_id = str(uuid.uuid4())
+        self.active.add(entry_id)
+        await self._write(lambda: db.journal_insert(entry_id, endpoint.id, PaymentState.received,
+                                                    sender_email, subject, message, amount, payment_header))
+        return entry_id
+
+    async def record_verified(self, entry_id: str) -> None:
+        await self._write(lambda: db.journal_update(entry_id, PaymentState.verified))
+
+    async def record_settled(self, entry_id: str, endpoint_id: str, sender_email: str, subject: str, amount: Decimal, settlement: dict) -> None:
+        """Mark the entry settled and book the payment in the same transaction."""
+        def op():
+            db.journal_update(entry_id, PaymentState.settled, settle_response=json.dumps(settlement))
+            db.record_payment(endpoint_id, sender_email, subject, amount,
+                              network=settlement.get("network"), payer=settlement.get("payer"),
+                              transaction_hash=settlement.get("transaction"))
+            db.update_pay_count(endpoint_id)
+        await self._write(op)
+
+    async def record_delivered(self, entry_id: str) -> None:
+        await self._write(lambda: db.journal_update(entry_id, PaymentState.delivered, attempted=True, terminal=True))
+
+    async def record_delivery_error(self, entry_id: str, error: str, attempts: int) -> None:
+        """Keep a settled entry for retry, or fail it once it ran out of attempts.
+
+        A failed delivery keeps its message and payment header: the payer was charged,
+        so an operator can still resend it.
+        """
+        state = PaymentState.failed if attempts + 1 >= MAX_DELIVERY_ATTEMPTS else PaymentState.settled
+        await self._write(lambda: db.journal_update(entry_id, state, error=error, attempted=True))
+
+    async def record_failed(self, entry_id: str, error: str) -> None:
+        await self._write(lambda: db.journal_update(entry_id, PaymentState.failed, error=error, terminal=True))
+
+
+async def _settlement_status(entry) -> bool | None:
+    """True if the entry's payment settled on-chain, False if it never can, None if that isn't known yet."""
+    try:
+        payload = x402.decode_payment_payload(entry.payment_header)
+        if await x402.authorization_used(payload): return True
+        return False if x402.authorization_expired(payload) else None
+    except Exception as e:
+        logger.warning(f"Could not check settlement of journal entry {entry.id}: {e}")
+        return None
+
+
+async def recover(journal: PaymentJournal, deliver) -> dict:
+    """Resume or reconcile incomplete entries that no request is working on.
+
+    - received: nothing was charged; marked failed.
+    - verified: settle may or may not have gone through, so the signed authorization is
+      checked on-chain. Used means the payer was charged: the entry is booked as settled
+      and delivered. Unused and expired means it never can be: marked failed. Otherwise
+      (unused but still valid, or the check failed) it is left for the next pass.
+    - settled: the payer was charged, so delivery is retried with `await deliver(endpoint, entry)`.
+    """
+    summary = {"delivered": 0, "retry_later": 0, "unresolved": 0, "failed": 0}
+    for entry in db.list_incomplete_journal_entries(INCOMPLETE_STATES):
+        if entry.id in journal.active: continue
+        if entry.state == PaymentState.received:
+            await journal.record_failed(entry.id, "interrupted before verification; payer was not charged")
+            summary["failed"] += 1
+            continue
+
+        if entry.state == PaymentState.verified:
+            settled = await _settlement_status(entry) if entry.payment_header else False
+            if settled is None:
+                summary["unresolved"] += 1
+                continue
+            if not settled:
+                reason = ("authorization expired unused; payer was not charged" if entry.payment_header
+                          else "interrupted during settlement; check payer transaction before refunding")
+                await journal.record_failed(entry.id, reason)
+                summary["failed"] += 1
+                continue
+            payload = x402.decode_payment_payload(entry.payment_header)
+            await journal.record_settled(entry.id, entry.endpoint_id, entry.sender_email, entry.subject, entry.amount, {
+                "success": True, "network": payload["network"], "transaction": None,
+                "payer": payload["payload"]["authorization"]["from"], "reconciled": True,
+            })
+
+        endpoint = db.get_endpoint(entry.endpoint_id)
+        try:
+            if endpoint is None: raise LookupError(f"endpoint {entry.endpoint_id} no longer exists")
+            await deliver(endpoint, entry)
+        except Exception as e:
+            logger.error(f"Recovery delivery failed for journal entry {entry.id}: {e}")
+            await journal.record_delivery_error(entry.id, f"recovery: {e}", entry.attempts)
+            summary["failed" if entry.attempts + 1 >= MAX_DELIVERY_ATTEMPTS else "retry_later"] += 1
+        else:
+            await journal.record_delivered(entry.id)
+            summary["delivered"] += 1
+    if any(summary.values()): logger.info(f"Payment journal recovery finished: {summary}")
+    return summary
+
+
+async def recovery_loop(journal: PaymentJournal, deliver, interval: float):
+    """Recover once at startup, then keep retrying failed deliveries every `interval` seconds."""
+    while True:
+        try: await recover(journal, deliver)
+        except Exception as e: logger.error(f"Payment journal recovery failed: {e}")
+        await asyncio.sleep(interval)
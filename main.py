@@ -1,9 +1,12 @@
+import asyncio
 import json
 import base64
 import shutil
 import datetime as dt
 import logging
+import math
 import os
+import signal
 from decimal import Decimal
 from dotenv import load_dotenv
 
@@ -12,8 +15,13 @@ from fasthtml.oauth import GoogleAppClient, OAuth
 from fastcore.all import *
 from monsterui.all import *
 import resend
+from starlette.datastructures import Headers
+from starlette.responses import StreamingResponse
 
 import db
+import export
+import journal
+import maintenance
 import x402
 
 # Setup logging
@@ -46,7 +54,18 @@ hdrs = (
 )
 
 
-app = FastHTML(hdrs=hdrs)
+# Lifespan hooks; the functions they call are defined further down with the payment and maintenance code
+async def app_startup():
+    await start_draining_on_signal()
+    await start_recovery()
+    await start_maintenance()
+
+async def app_shutdown():
+    await stop_maintenance()
+    await stop_recovery()
+    await drain_payments()
+
+app = FastHTML(hdrs=hdrs, on_startup=[app_startup], on_shutdown=[app_shutdown])
 rt = app.route
 
 # Mount fixed "static/" folder under /static
@@ -129,9 +148,18 @@ def index(auth):
         )
 
 
-def EndpointsContainer(endpoints):
+def ExportLinks():
+    return DivHStacked(
+        P("Export:", cls=TextPresets.muted_sm),
+        A("Endpoints CSV", href="/export/endpoints?fmt=csv", cls="text-sm"),
+        A("Payments CSV", href="/export/payments?fmt=csv", cls="text-sm"),
+        A("Payments NDJSON", href="/export/payments?fmt=ndjson", cls="text-sm"),
+    )
+
+def EndpointsContainer(endpoints, notice=None):
     return Card(
-        H3("Email Endpoints"),
+        DivFullySpaced(H3("Email Endpoints"), ExportLinks()),
+        P(notice, cls=TextPresets.muted_sm) if notice else None,
         EndpointsTable(endpoints),
         id="endpoints-container"
     )
@@ -141,7 +169,7 @@ def EndpointRow(endpoint):
             Td(endpoint.email),
             Td(endpoint.label or "-"),
             Td(A(share_url, href=share_url, target="_blank", cls="text-sm")),
-            Td(f"${endpoint.base_price:.6f}"),
+            Td(P(f"${endpoint.base_price:.6f}"), *[P(f"≥{b} B: ${p:.6f}", cls=TextPresets.muted_sm) for b, p in db.get_price_tiers(endpoint.id)]),
             Td("Active" if endpoint.is_active else "Inactive"),
             Td(str(endpoint.hit_count)),
             Td(str(endpoint.payment_count)),
@@ -177,6 +205,7 @@ def CreateEndpointForm():
                 Input(placeholder="Email address", name="email", required=True),
                 Input(placeholder="Label users will see when sharing (e.g. your name)", name="label", required=True),
                 Input(type="float", placeholder="Price in USDC", name="base_price", required=True),
+                Input(placeholder="Optional size tiers, bytes:price (e.g. 2000:0.05, 10000:0.2)", name="price_tiers"),
                 Button("Create", type="submit"),
             ),
         ),
@@ -185,16 +214,70 @@ def CreateEndpointForm():
         hx_swap="outerHTML"
     )
 
+def parse_price_tiers(spec: str, base_price: float):
+    """Parse "2000:0.05, 10000:0.2" into [(2000, 0.05), (10000, 0.2)].
+
+    Raises ValueError unless sizes are unique positive integers and prices are finite,
+    at least `base_price` and never cheaper for a larger size.
+    """
+    tiers = []
+    for part in filter(None, (p.strip() for p in spec.split(","))):
+        try:
+            min_bytes, price = part.split(":")
+            min_bytes, price = int(min_bytes), float(price)
+        except ValueError: raise ValueError(f"'{part}' is not bytes:price")
+        if min_bytes <= 0: raise ValueError(f"'{part}': size must be positive")
+        if not math.isfinite(price): raise ValueError(f"'{part}': price must be a number")
+        if price < base_price: raise ValueError(f"'{part}': price is below the base price")
+        tiers.append((min_bytes, price))
+    tiers.sort()
+    for (size, price), (next_size, next_price) in zip(tiers, tiers[1:]):
+        if size == next_size: raise ValueError(f"size {size} appears twice")
+        if next_price < price: raise ValueError(f"{next_size} bytes costs less than {size} bytes")
+    return tiers
+
 @rt
-def create_endpoint(email: str,  base_price: float, label: str = "", auth = ''):
-    if base_price <= 0: return "Invalid price"
+def create_endpoint(email: str,  base_price: float, label: str = "", price_tiers: str = "", auth = ''):
+    if not math.isfinite(base_price) or base_price <= 0: return "Invalid price"
+    try: tiers = parse_price_tiers(price_tiers, base_price)
+    except ValueError as e: return f"Invalid price tiers: {e}"
 
     base_price = base_price
     
-    endpoint_id = db.create_email_endpoint(auth, email, label, base_price)
+    endpoint_id = db.create_email_endpoint(auth, email, label, base_price, tiers)
     endpoints = db.list_endpoints_by_user(auth)
+
+    unreachable = [size for size, _ in tiers if size >= MAX_BODY_BYTES]
+    notice = f"Tiers from {', '.join(map(str, unreachable))} bytes never apply: messages are limited to {MAX_BODY_BYTES} bytes." if unreachable else None
     
-    return EndpointsContainer(endpoints)
+    return EndpointsContainer(endpoints, notice)
+
+def parse_date_range(start: str, end: str):
+    """Validate optional ISO `start`/`end` dates. Returns (start, end) or raises ValueError."""
+    start = dt.date.fromisoformat(start).isoformat() if start else None
+    end = dt.date.fromisoformat(end).isoformat() if end else None
+    if start and end and start > end: raise ValueError("start must not be after end")
+    return start, end
+
+def export_response(kind: str, fmt: str, columns: tuple, rows):
+    filename = f"forward-x402-{kind}-{dt.date.today().isoformat()}.{fmt}"
+    return StreamingResponse(export.stream_rows(fmt, columns, rows),
+                             media_type=export.EXPORT_FORMATS[fmt],
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+@app.get("/export/{kind}")
+def export_history(kind: str, auth, fmt: str = "csv", start: str = "", end: str = ""):
+    exporters = {
+        "endpoints": (db.ENDPOINT_EXPORT_COLUMNS, db.iter_endpoints_by_user),
+        "payments": (db.PAYMENT_EXPORT_COLUMNS, db.iter_payments_by_user),
+    }
+    if kind not in exporters: return JSONResponse(status_code=404, content={"error": "Unknown export"})
+    if fmt not in export.EXPORT_FORMATS: return JSONResponse(status_code=400, content={"error": f"fmt must be one of {list(export.EXPORT_FORMATS)}"})
+    try: start, end = parse_date_range(start, end)
+    except ValueError as e: return JSONResponse(status_code=400, content={"error": f"Invalid date range: {e}"})
+
+    columns, iter_rows = exporters[kind]
+    return export_response(kind, fmt, columns, iter_rows(auth, start, end))
 
 @app.get("/forward/{short_url}")
 async def forward_endpoint(short_url: str, request: Request):
@@ -203,6 +286,7 @@ async def forward_endpoint(short_url: str, request: Request):
     
     # Get payment requirements
     payment_data = await get_payment_requirements(endpoint, str(request.url).replace('/forward/', '/forward/'))
+    tiers = db.get_price_tiers(endpoint.id)
     
     curl_example = f"""curl -X POST {SERVER_URL}/forward/{short_url} \\
   -H "Content-Type: application/json" \\
@@ -228,7 +312,9 @@ async def forward_endpoint(short_url: str, request: Request):
                 ),
                 Card(
                     H3("Send Email to `" + endpoint.label + "`", cls="text-lg font-semibold mb-4"),
-                    P(f"Price: ${endpoint.base_price:.6f} USDC", cls="text-gray-700 mb-6"),
+                    P(f"Price: ${endpoint.base_price:.6f} USDC", cls="text-gray-700 mb-2"),
+                    *[P(f"Messages of {b} bytes or more: ${p:.6f} USDC", cls=TextPresets.muted_sm) for b, p in tiers],
+                    P(f"Messages are limited to {MAX_BODY_BYTES} bytes.", cls=TextPresets.muted_sm + " mb-6"),
                     Form(
                         Input(placeholder="Your email", name="email", required=True, cls="w-full border border-gray-300 p-2 mb-4"),
                         Input(placeholder="Subject", name="subject", required=True, cls="w-full border border-gray-300 p-2 mb-4"),
@@ -236,7 +322,8 @@ async def forward_endpoint(short_url: str, request: Request):
                         Input(placeholder="X402 Payment Header", name="x402_header", required=True, cls="w-full border border-gray-300 p-2 mb-4"),
                     ),
                     Button("Connect Wallet", cls="wallet-connect btn btn-primary w-full p-2 mb-4"),
-                    Button("Pay & Send", cls="wallet-pay btn btn-success w-full p-2", data_payment=payment_data),
+                    Button("Pay & Send", cls="wallet-pay btn btn-success w-full p-2", data_payment=payment_data,
+                           data_price_tiers=json.dumps([[b, int(p * 1_000_000)] for b, p in tiers])),
                 ),
                 Card(
                     Details(
@@ -248,10 +335,17 @@ async def forward_endpoint(short_url: str, request: Request):
         )
     )
 
-async def get_payment_requirements(endpoint, request_url):
-    """Get X402 payment requirements for an endpoint"""
+def price_for_message(endpoint, tiers, message_bytes: int) -> Decimal:
+    """Price of a message: the largest size tier it reaches, else the endpoint's base price."""
+    price = endpoint.base_price
+    for min_bytes, tier_price in tiers:
+        if message_bytes >= min_bytes: price = tier_price
+    return Decimal(str(price))
+
+async def get_payment_requirements(endpoint, request_url, amount: Decimal | None = None):
+    """Get X402 payment requirements for an endpoint (at its base price unless `amount` is given)"""
     facilitator_config = x402.create_x402_facilitator_config()
-    amount = Decimal(str(endpoint.base_price))
+    amount = amount if amount is not None else Decimal(str(endpoint.base_price))
     
     response = await x402.payment_middleware(
         url=request_url,
@@ -271,59 +365,219 @@ async def get_payment_requirements(endpoint, request_url):
     return json.dumps(json.loads(response.body.decode())['accepts'][0])
 
 
+MAX_BODY_BYTES = int(os.environ.get("FORWARD_MAX_BODY_BYTES", str(64 * 1024)))
+
+def validate_payload(body: bytes) -> dict:
+    """Decode a forward request body. Raises ValueError unless it is a JSON object with string fields."""
+    payload = json.loads(body)
+    if not isinstance(payload, dict): raise ValueError("expected a JSON object")
+    for field in ("email", "subject", "message"):
+        value = payload.get(field)
+        if value is None: continue
+        if not isinstance(value, str): raise ValueError(f"{field} must be a string")
+        value.encode()  # UnicodeEncodeError (a ValueError) on lone surrogates such as "\ud800"
+    return payload
+
+class ForwardBodyLimit:
+    """ASGI middleware that bounds POST /forward/* bodies before the framework reads them.
+
+    FastHTML parses the body itself before calling the handler, so the cap has to
+    sit in front of it: the body is buffered up to `max_bytes` (413 beyond that, or
+    as soon as Content-Length says so), validated as JSON (400), then replayed.
+    """
+    def __init__(self, app, max_bytes: int):
+        self.app, self.max_bytes = app, max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or not scope["path"].startswith("/forward/"):
+            return await self.app(scope, receive, send)
+
+        too_large = JSONResponse(status_code=413, content={"error": f"Request body exceeds {self.max_bytes} bytes"})
+        declared = Headers(scope=scope).get("content-length", "")
+        if declared.isdigit() and int(declared) > self.max_bytes: return await too_large(scope, receive, send)
+
+        body, more_body = bytearray(), True
+        while more_body:
+            message = await receive()
+            if message["type"] == "http.disconnect": return
+            body += message.get("body", b"")
+            if len(body) > self.max_bytes: return await too_large(scope, receive, send)
+            more_body = message.get("more_body", False)
+
+        try: validate_payload(body)
+        except ValueError as e:
+            return await JSONResponse(status_code=400, content={"error": f"Invalid JSON body: {e}"})(scope, receive, send)
+
+        replayed = False
+        async def replay():
+            nonlocal replayed
+            if replayed: return await receive()
+            replayed = True
+            return {"type": "http.request", "body": bytes(body), "more_body": False}
+        await self.app(scope, replay, send)
+
+app.add_middleware(ForwardBodyLimit, max_bytes=MAX_BODY_BYTES)
+
 async def parse_payload(request):
-    body = await request.json()
-    return body.get("email"), body.get("subject"), body.get("message"), request.headers.get("X-PAYMENT")
+    """Raises ValueError on a malformed body (normally already rejected by ForwardBodyLimit)."""
+    payload = validate_payload(await request.body())
+    return payload.get("email"), payload.get("subject"), payload.get("message"), request.headers.get("X-PAYMENT")
+
+def send_forward_email(endpoint, sender_email, subject, message):
+    """Deliver a paid message to the endpoint owner via Resend."""
+    params = {
+        "from": "noreply@fewsats.com",
+        "to": [endpoint.email],
+        "subject": f"[Paid Email] {subject}",
+        "html": f"<div><p><strong>From:</strong> {sender_email}</p><p><strong>Message:</strong></p><div>{message.replace(chr(10), '<br>')}</div></div>",
+        "reply_to": sender_email
+    }
+    return resend.Emails.send(params)
+
+# Payments in flight are tracked so shutdown can drain them. On SIGTERM/SIGINT
+# `draining` is set straight away, so new payments get a 503 while uvicorn lets
+# open requests finish (with no time limit under serve(); pass
+# --timeout-graceful-shutdown when running uvicorn directly). SHUTDOWN_DRAIN_SECONDS
+# then bounds the lifespan-shutdown wait for payment tasks that outlived their
+# connection; anything still unfinished is left in the journal for recovery.
+payment_journal = journal.PaymentJournal()
+inflight_payments: set[asyncio.Task] = set()
+draining = False
+SHUTDOWN_DRAIN_SECONDS = float(os.environ.get("SHUTDOWN_DRAIN_SECONDS", "20"))
+DELIVERY_RETRY_SECONDS = float(os.environ.get("DELIVERY_RETRY_SECONDS", "300"))
+
+async def process_payment(endpoint, request, sender_email, subject, message, x_payment):
+    amount = price_for_message(endpoint, db.get_price_tiers(endpoint.id), len(message.encode()))
+    entry_id = await payment_journal.record_received(endpoint, sender_email, subject, message, amount, x_payment) if x_payment else None
+    verified = False
+
+    async def on_verified():
+        nonlocal verified
+        await payment_journal.record_verified(entry_id)
+        verified = True
+
+    try:
+        # Process payment
+        facilitator_config = x402.create_x402_facilitator_config()
+
+        response = await x402.payment_middleware(
+            url=str(request.url),
+            x_payment=x_payment,
+            user_agent=request.headers.get("User-Agent", ""),
+            accept_header=request.headers.get("Accept", ""),
+            amount=amount,
+            address=os.environ.get("X402_PAYMENT_ADDRESS", ""),
+            facilitator_config=facilitator_config,
+            description=f"Send email to {endpoint.label}",
+            mime_type="application/json",
+            max_timeout_seconds=int(os.environ.get("X402_MAX_TIMEOUT_SECONDS", "300")),
+            testnet=os.environ.get("ENV", "dev") == "dev",
+            resource=f"/forward/{endpoint.short_url}",
+            on_verified=on_verified if entry_id else None,
+        )
+        
+        if response.status_code >= 400:
+            if verified:
+                # Settle raised or its answer was lost: the payer may have been charged, so the
+                # entry stays verified (header kept) and the recovery pass checks it on-chain
+                logger.error(f"Settlement outcome unknown for journal entry {entry_id} ({response.status_code}), leaving it to recovery")
+            elif entry_id: await payment_journal.record_failed(entry_id, f"payment rejected ({response.status_code})")
+            return response
+
+        settlement = json.loads(base64.b64decode(response.headers["X-PAYMENT-RESPONSE"]))
+        if not settlement.get("success"):
+            reason = settlement.get("errorReason") or "Settlement failed"
+            await payment_journal.record_failed(entry_id, f"settlement unsuccessful: {reason}")
+            return JSONResponse(status_code=402, content={"error": reason, "x402Version": x402.X402_VERSION})
+
+        try: await payment_journal.record_settled(entry_id, endpoint.id, sender_email, subject, amount, settlement)
+        except Exception as e:
+            # The payer has been charged: deliver regardless, and make the missing record loud
+            logger.critical(f"Payment settled but not journaled (entry {entry_id}, settlement {settlement}): {e}")
+    
+        # Send email via Resend
+        try:
+            email_result = await asyncio.to_thread(send_forward_email, endpoint, sender_email, subject, message)
+            logger.info(f"Email sent successfully via Resend: {email_result}")
+        except Exception as e:
+            logger.error(f"Failed to send email via Resend: {e}")
+            await payment_journal.record_delivery_error(entry_id, str(e), attempts=0)
+            return JSONResponse(status_code=500, content={"error": "Failed to send email, delivery will be retried"})
+
+        try: await payment_journal.record_delivered(entry_id)
+        except Exception as e: logger.critical(f"Email delivered but not journaled (entry {entry_id}): {e}")
+        return JSONResponse(status_code=200,
+            content={ "success": True,  "message": "Email sent successfully" },
+        )
+    finally:
+        # Whatever state the entry is left in, the recovery loop now owns it
+        payment_journal.active.discard(entry_id)
 
 @app.post("/forward/{short_url}")
 async def forward_payment(short_url: str, request: Request):
-    endpoint = db.get_endpoint_by_short_url(short_url)
-    db.update_hit_count(endpoint.id)
+    if draining: return JSONResponse(status_code=503, content={"error": "Server is shutting down, retry shortly"})
 
+    endpoint = db.get_endpoint_by_short_url(short_url)
     if not endpoint: return JSONResponse(status_code=404, content={"error": "Endpoint not found"})
+    db.update_hit_count(endpoint.id)
     
-    sender_email, subject, message, x_payment = await parse_payload(request)
+    try: sender_email, subject, message, x_payment = await parse_payload(request)
+    except ValueError as e: return JSONResponse(status_code=400, content={"error": f"Invalid JSON body: {e}"})
     if not all([sender_email, subject, message]): return JSONResponse(status_code=400, content={"error": "Missing required fields"})
 
-    # Process payment
-    facilitator_config = x402.create_x402_facilitator_config()
-    amount = Decimal(str(endpoint.base_price))
-
-    response = await x402.payment_middleware(
-        url=str(request.url),
-        x_payment=x_payment,
-        user_agent=request.headers.get("User-Agent", ""),
-        accept_header=request.headers.get("Accept", ""),
-        amount=amount,
-        address=os.environ.get("X402_PAYMENT_ADDRESS", ""),
-        facilitator_config=facilitator_config,
-        description=f"Send email to {endpoint.label}",
-        mime_type="application/json",
-        max_timeout_seconds=int(os.environ.get("X402_MAX_TIMEOUT_SECONDS", "300")),
-        testnet=os.environ.get("ENV", "dev") == "dev",
-        resource=f"/forward/{short_url}"
-    )
-        
-    if response.status_code >= 400: return response
-    
-    # Send email via Resend
-    try:
-        params = {
-            "from": "noreply@fewsats.com",
-            "to": [endpoint.email],
-            "subject": f"[Paid Email] {subject}",
-            "html": f"<div><p><strong>From:</strong> {sender_email}</p><p><strong>Message:</strong></p><div>{message.replace(chr(10), '<br>')}</div></div>",
-            "reply_to": sender_email
-        }
-        
-        email_result = resend.Emails.send(params)
-        logger.info(f"Email sent successfully via Resend: {email_result}")
-            
-        return JSONResponse(status_code=200,
-            content={ "success": True,  "message": "Email sent successfully" },
-        )
-    except Exception as e:
-        logger.error(f"Failed to send email via Resend: {e}")
-        return JSONResponse(status_code=500, content={"error": "Failed to send email"})
+    # Shielded so a client disconnect can't abandon a payment between settle and delivery
+    task = asyncio.create_task(process_payment(endpoint, request, sender_email, subject, message, x_payment))
+    inflight_payments.add(task)
+    task.add_done_callback(inflight_payments.discard)
+    return await asyncio.shield(task)
+
+async def deliver_recovered(endpoint, entry):
+    await asyncio.to_thread(send_forward_email, endpoint, entry.sender_email, entry.subject, entry.message)
+
+recovery_task: asyncio.Task | None = None
+
+async def start_recovery():
+    # In the background so a Resend outage can't hold up startup
+    global recovery_task
+    recovery_task = asyncio.create_task(journal.recovery_loop(payment_journal, deliver_recovered, DELIVERY_RETRY_SECONDS))
+
+def install_drain_signal_handlers():
+    """Start draining as soon as a shutdown signal arrives, then defer to the server's own handler."""
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        previous = signal.getsignal(sig)
+        def handler(signum, frame, previous=previous):
+            global draining
+            draining = True
+            if callable(previous): return previous(signum, frame)
+            if previous != signal.SIG_IGN:
+                signal.signal(signum, signal.SIG_DFL)
+                os.kill(os.getpid(), signum)
+        signal.signal(sig, handler)
+
+async def start_draining_on_signal():
+    # Installed at startup, after uvicorn has set up its own handlers, so it can chain to them
+    install_drain_signal_handlers()
+
+async def drain_payments():
+    global draining
+    draining = True
+    if inflight_payments:
+        logger.info(f"Draining {len(inflight_payments)} in-flight payments (deadline {SHUTDOWN_DRAIN_SECONDS}s)")
+        _, pending = await asyncio.wait(set(inflight_payments), timeout=SHUTDOWN_DRAIN_SECONDS)
+        if pending: logger.warning(f"{len(pending)} payments still in flight at shutdown, left for startup recovery")
+    await payment_journal.close()
+
+maintenance_task: asyncio.Task | None = None
+
+async def start_maintenance():
+    global maintenance_task
+    maintenance_task = asyncio.create_task(maintenance.maintenance_loop(is_busy=lambda: bool(inflight_payments)))
+
+async def stop_maintenance():
+    maintenance.request_stop()
+    if maintenance_task: maintenance_task.cancel()
+
+async def stop_recovery():
+    if recovery_task: recovery_task.cancel()
 
 serve()
\ No newline at end of file
@@ -0,0 +1,180 @@
+import asyncio
+import datetime as dt
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+
+import apsw
+
+import db
+
+logger = logging.getLogger(__name__)
+
+
+def _env_int(name: str, default: int) -> int: return int(os.environ.get(name, str(default)))
+
+
+def parse_quiet_hours(spec: str) -> tuple[int, int] | None:
+    """Parse "start-end" UTC hours (end exclusive, may wrap past midnight). Empty means any time."""
+    if not spec.strip(): return None
+    try:
+        start, end = (int(h) for h in spec.split("-"))
+        if not (0 <= start <= 23 and 0 <= end <= 24 and start != end): raise ValueError()
+    except ValueError:
+        raise ValueError(f"MAINTENANCE_QUIET_HOURS_UTC must look like '2-5' (UTC hours, end exclusive), got {spec!r}")
+    return start, end
+
+# Every write step below is kept small so the write lock is only ever held for a few
+# milliseconds: /forward writers (busy timeout ~100ms) wait at most one step.
+INTERVAL_SECONDS = _env_int("MAINTENANCE_INTERVAL_SECONDS", 3600)
+# Validated here so a bad value fails at startup instead of inside the background task
+QUIET_HOURS = parse_quiet_hours(os.environ.get("MAINTENANCE_QUIET_HOURS_UTC", "2-5"))
+VACUUM_STEP_PAGES = _env_int("MAINTENANCE_VACUUM_STEP_PAGES", 64)
+VACUUM_MAX_STEPS = _env_int("MAINTENANCE_VACUUM_MAX_STEPS", 200)
+# A one-off full VACUUM is needed to switch on incremental auto-vacuum; only do it while the file is small
+AUTO_VACUUM_CONVERT_MAX_PAGES = _env_int("MAINTENANCE_AUTO_VACUUM_CONVERT_MAX_PAGES", 1000)
+RETENTION_BATCH_ROWS = _env_int("MAINTENANCE_RETENTION_BATCH_ROWS", 200)
+STEP_PAUSE_SECONDS = 0.05
+REPORTS_KEPT = 500
+
+archive_dir = db.db_path.parent / "archive"
+
+# Set on shutdown; a pass running in its worker thread stops at the next step boundary
+stop_requested = threading.Event()
+
+# (table, days env var, extra WHERE clause). 0 days keeps rows forever.
+RETENTION = (
+    ("payment_journal", "RETENTION_DAYS_JOURNAL", "state IN ('delivered', 'failed')"),
+    ("payments", "RETENTION_DAYS_PAYMENTS", "1"),
+)
+
+
+def in_quiet_hours(now: dt.datetime | None = None, hours: tuple[int, int] | None = QUIET_HOURS) -> bool:
+    if hours is None: return True
+    start, end = hours
+    hour = (now or dt.datetime.now(dt.timezone.utc)).hour
+    return start <= hour < end if start <= end else hour >= start or hour < end
+
+
+def _pragma(conn, sql):
+    return conn.execute(f"PRAGMA {sql}").fetchone()
+
+
+def optimize(conn) -> dict:
+    """Refresh planner statistics with a bounded ANALYZE, then let SQLite decide what else to optimize."""
+    _pragma(conn, "analysis_limit = 1000")
+    conn.execute("ANALYZE")
+    conn.execute("PRAGMA optimize")
+    return {"analyzed": True}
+
+
+def incremental_vacuum(conn) -> dict:
+    """Return free pages to the filesystem a few at a time."""
+    mode = _pragma(conn, "auto_vacuum")[0]
+    if mode != 2:
+        pages = _pragma(conn, "page_count")[0]
+        if pages > AUTO_VACUUM_CONVERT_MAX_PAGES:
+            return {"skipped": f"auto_vacuum is not incremental and database has {pages} pages; run VACUUM manually"}
+        _pragma(conn, "auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        return {"converted_to_incremental": True, "pages": pages}
+
+    freed, steps = 0, 0
+    while steps < VACUUM_MAX_STEPS and not stop_requested.is_set():
+        free = _pragma(conn, "freelist_count")[0]
+        if not free: break
+        conn.execute(f"PRAGMA incremental_vacuum({min(free, VACUUM_STEP_PAGES)})").fetchall()
+        freed += min(free, VACUUM_STEP_PAGES)
+        steps += 1
+        time.sleep(STEP_PAUSE_SECONDS)
+    return {"pages_freed": freed, "steps": steps, "pages_still_free": _pragma(conn, "freelist_count")[0]}
+
+
+def checkpoint(conn) -> dict:
+    """PASSIVE checkpoint: copies what it can without waiting on, or blocking, readers and writers."""
+    wal_frames, checkpointed = conn.wal_checkpoint(mode=apsw.SQLITE_CHECKPOINT_PASSIVE)
+    return {"wal_frames": wal_frames, "checkpointed": checkpointed}
+
+
+def archive_old_rows(conn, table: str, days: int, where: str) -> dict:
+    """Move rows older than `days` into a gzipped NDJSON file under data/archive, batch by batch.
+
+    Each batch is written and flushed to the archive before its rows are deleted in
+    one short transaction, so a crash can duplicate rows in an archive but never lose them.
+    """
+    cutoff = (dt.datetime.now(dt.timezone.utc) - dt.timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+    archive_dir.mkdir(parents=True, exist_ok=True)
+    path = archive_dir / f"{table}-{dt.date.today().isoformat()}.ndjson.gz"
+    existed, archived = path.exists(), 0
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})").fetchall()]
+    with gzip.open(path, "at", encoding="utf-8") as f:
+        while True:
+            rows = conn.execute(f"SELECT {', '.join(columns)} FROM {table} WHERE created_at < ? AND {where} ORDER BY created_at, id LIMIT ?",
+                                (cutoff, RETENTION_BATCH_ROWS)).fetchall()
+            if not rows: break
+            for row in rows: f.write(json.dumps(dict(zip(columns, row)), default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+            ids = [row[columns.index("id")] for row in rows]
+            with conn:
+                conn.execute(f"DELETE FROM {table} WHERE id IN ({', '.join('?' * len(ids))})", ids)
+            archived += len(rows)
+            if len(rows) < RETENTION_BATCH_ROWS or stop_requested.is_set(): break
+            time.sleep(STEP_PAUSE_SECONDS)
+    if not archived and not existed: path.unlink()
+    return {"archived": archived, "cutoff": cutoff, "file": str(path) if archived else None}
+
+
+def run_maintenance() -> dict:
+    """Run one maintenance pass on its own connection and record what it did."""
+    started_at = dt.datetime.now(dt.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    start = time.monotonic()
+    conn = apsw.Connection(str(db.db_path))
+    conn.setbusytimeout(250)
+    report = {}
+    try:
+        for table, env_var, where in RETENTION:
+            days = _env_int(env_var, 0)
+            if days > 0: report[f"retention_{table}"] = _step(archive_old_rows, conn, table, days, where)
+        report["optimize"] = _step(optimize, conn)
+        report["incremental_vacuum"] = _step(incremental_vacuum, conn)
+        report["checkpoint"] = _step(checkpoint, conn)
+
+        duration_ms = int((time.monotonic() - start) * 1000)
+        if stop_requested.is_set():
+            logger.info(f"Database maintenance stopped for shutdown after {duration_ms}ms: {report}")
+            return report
+        with conn:
+            conn.execute("INSERT INTO maintenance_runs (started_at, duration_ms, report) VALUES (?, ?, ?)",
+                         (started_at, duration_ms, json.dumps(report)))
+            conn.execute("DELETE FROM maintenance_runs WHERE id <= (SELECT MAX(id) FROM maintenance_runs) - ?", (REPORTS_KEPT,))
+    finally:
+        conn.close()
+    logger.info(f"Database maintenance finished in {duration_ms}ms: {report}")
+    return report
+
+
+def _step(fn, *args) -> dict:
+    """Run one maintenance step; a failure (e.g. SQLITE_BUSY) is reported instead of aborting the run."""
+    if stop_requested.is_set(): return {"skipped": "shutting down"}
+    try: return fn(*args)
+    except Exception as e:
+        logger.warning(f"Maintenance step {fn.__name__} failed: {e}")
+        return {"error": str(e)}
+
+
+async def maintenance_loop(is_busy=lambda: False):
+    """Run maintenance every INTERVAL_SECONDS during quiet hours, skipping while `is_busy()`."""
+    while True:
+        await asyncio.sleep(INTERVAL_SECONDS)
+        try:
+            if not in_quiet_hours() or is_busy(): continue
+            await asyncio.to_thread(run_maintenance)
+        except Exception as e: logger.error(f"Database maintenance failed: {e}")
+
+
+def request_stop():
+    stop_requested.set()
@@ -0,0 +1,17 @@
+-- Payment history for settled forwards
+
+CREATE TABLE IF NOT EXISTS payments (
+    id TEXT PRIMARY KEY,
+    endpoint_id TEXT NOT NULL,
+    sender_email TEXT NOT NULL,
+    subject TEXT,
+    amount INTEGER NOT NULL,
+    network TEXT,
+    payer TEXT,
+    transaction_hash TEXT,
+    created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (endpoint_id) REFERENCES email_endpoints(id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_payments_endpoint_created ON payments (endpoint_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_email_endpoints_user_created ON email_endpoints (user_id, created_at);
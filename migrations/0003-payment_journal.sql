@@ -0,0 +1,19 @@
+-- Write-ahead journal of forward payment state transitions
+
+CREATE TABLE IF NOT EXISTS payment_journal (
+    id TEXT PRIMARY KEY,
+    endpoint_id TEXT NOT NULL,
+    state TEXT NOT NULL,
+    sender_email TEXT NOT NULL,
+    subject TEXT,
+    message TEXT,
+    amount INTEGER NOT NULL,
+    settle_response TEXT,
+    error TEXT,
+    attempts INTEGER DEFAULT 0,
+    created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+    updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (endpoint_id) REFERENCES email_endpoints(id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_payment_journal_state ON payment_journal (state, created_at);
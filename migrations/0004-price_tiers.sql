@@ -0,0 +1,9 @@
+-- Optional per-endpoint pricing by message size
+
+CREATE TABLE IF NOT EXISTS endpoint_price_tiers (
+    endpoint_id TEXT NOT NULL,
+    min_bytes INTEGER NOT NULL,
+    price INTEGER NOT NULL,
+    PRIMARY KEY (endpoint_id, min_bytes),
+    FOREIGN KEY (endpoint_id) REFERENCES email_endpoints(id)
+);
@@ -0,0 +1,11 @@
+-- Reports from the background database maintenance task
+
+CREATE TABLE IF NOT EXISTS maintenance_runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started_at TEXT NOT NULL,
+    duration_ms INTEGER NOT NULL,
+    report TEXT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_payment_journal_created ON payment_journal (created_at);
+CREATE INDEX IF NOT EXISTS idx_payments_created ON payments (created_at);
@@ -0,0 +1,3 @@
+-- Keep the signed X-PAYMENT header until an entry is resolved, so recovery can check settlement on-chain
+
+ALTER TABLE payment_journal ADD COLUMN payment_header TEXT;
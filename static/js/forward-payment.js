@@ -3,6 +3,24 @@ document.addEventListener('DOMContentLoaded', function() {
     
     const payButton = document.querySelector('.wallet-pay');
     
+    // Keep the quoted amount in sync with the message size tier (sizes in UTF-8 bytes, amounts in USDC units)
+    const basePayment = JSON.parse(payButton.getAttribute('data-payment'));
+    const priceTiers = JSON.parse(payButton.getAttribute('data-price-tiers') || '[]');
+    const messageInput = document.querySelector('textarea[name="message"]');
+    
+    function updateQuote() {
+        const size = new TextEncoder().encode(messageInput.value).length;
+        let amount = basePayment.maxAmountRequired;
+        for (const [minBytes, tierAmount] of priceTiers) {
+            if (size >= minBytes) amount = String(tierAmount);
+        }
+        payButton.setAttribute('data-payment', JSON.stringify({ ...basePayment, maxAmountRequired: amount }));
+    }
+    
+    if (priceTiers.length && messageInput) {
+        messageInput.addEventListener('input', updateQuote);
+    }
+    
     function setLoading(loading) {
         if (loading) {
             payButton.disabled = true;
@@ -3,8 +3,9 @@ import base64
 import json
 import httpx
 import os
+import time
 from decimal import Decimal
-from typing import TypedDict, Protocol, Callable, Literal
+from typing import TypedDict, Protocol, Callable, Awaitable, Literal
 from enum import StrEnum
 from urllib.parse import urlparse, quote_plus
 
@@ -36,6 +37,7 @@ class PaymentMiddlewareOptions(TypedDict):
     custom_paywall_html: str
     resource: str
     resource_root_url: str
+    on_verified: Callable[[], Awaitable[None]]
 
 
 class Scheme(StrEnum):
@@ -47,6 +49,18 @@ class Network(StrEnum):
     base_sepolia = "base-sepolia"
 
 
+USDC_ADDRESSES = {
+    Network.base: "0x833589fCD6eDb6E08f4c7C32D4f71b54bdA02913",
+    Network.base_sepolia: "0x036CbD53842c5426634e7929541eC2318f3dCF7e",
+}
+BASE_RPC_URLS = {
+    Network.base: "https://mainnet.base.org",
+    Network.base_sepolia: "https://sepolia.base.org",
+}
+# authorizationState(address,bytes32) on EIP-3009 tokens such as USDC
+AUTHORIZATION_STATE_SELECTOR = "0xe94a0102"
+
+
 class PaymentRequirements(BaseModel):
     scheme: Scheme
     network: Network
@@ -170,6 +184,31 @@ def encode_to_base64(data: dict) -> str:
     return base64.b64encode(json.dumps(data).encode()).decode()
 
 
+async def authorization_used(payment_payload: dict) -> bool:
+    """Whether the payload's EIP-3009 transfer authorization has been used on-chain, i.e. it settled.
+
+    Queries USDC's `authorizationState(from, nonce)` over JSON-RPC (X402_RPC_URL, or Base's public node).
+    """
+    network = Network(payment_payload["network"])
+    authorization = payment_payload["payload"]["authorization"]
+    args = [authorization["from"], authorization["nonce"]]
+    data = AUTHORIZATION_STATE_SELECTOR + "".join(a.lower().removeprefix("0x").rjust(64, "0") for a in args)
+    async with httpx.AsyncClient() as client:
+        response = await client.post(os.environ.get("X402_RPC_URL") or BASE_RPC_URLS[network], json={
+            "jsonrpc": "2.0", "id": 1, "method": "eth_call",
+            "params": [{"to": USDC_ADDRESSES[network], "data": data}, "latest"],
+        })
+        response.raise_for_status()
+        result = response.json()
+    if "error" in result: raise RuntimeError(f"eth_call failed: {result['error']}")
+    return int(result["result"], 16) != 0
+
+
+def authorization_expired(payment_payload: dict) -> bool:
+    """Whether the authorization is past `validBefore`, after which it can never be settled."""
+    return int(payment_payload["payload"]["authorization"]["validBefore"]) <= time.time()
+
+
 def get_paywall_html(options: PaymentMiddlewareOptions) -> str:
     return "<html><body>Payment Required</body></html>"
 
@@ -185,13 +224,13 @@ async def payment_middleware(url: str, x_payment: str | None, user_agent: str |
     options = {**default_options, **kwargs}
 
     network = "base"
-    usdc_address = "0x833589fCD6eDb6E08f4c7C32D4f71b54bdA02913"
+    usdc_address = USDC_ADDRESSES[Network.base]
     facilitator_client = FacilitatorClient(options["facilitator_config"])
     max_amount_required = int(amount * 10**6)
 
     if options["testnet"]:
         network = "base-sepolia"
-        usdc_address = "0x036CbD53842c5426634e7929541eC2318f3dCF7e"
+        usdc_address = USDC_ADDRESSES[Network.base_sepolia]
 
 
     logger.info("Payment middleware checking request", extra={"url": url})
@@ -260,6 +299,9 @@ async def payment_middleware(url: str, x_payment: str | None, user_agent: str |
         )
     
     logger.info("Payment verified, proceeding")
+    if options.get("on_verified"):
+        await options["on_verified"]()
+
     try:
         settle_response = await facilitator_client.settle(payment_payload, payment_requirements)
     except Exception as e: